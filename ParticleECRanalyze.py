@@ -14,14 +14,11 @@ import tkFileDialog
 import xlsxwriter
 import math
 import numpy as np
-from measurement import measurement
+from analysis import analyze
 from mbox import mbox
 
 IN_FOLDER = '/'
 
-thresholds = [5, 10, 100] # Resistance thresholds under which to calculate strain
-strains = [0.1, 0.15, 0.2, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6] # Strains at which to find resistance
-  
 def writeToXlsx(filename, data):
     split_file = filename.split('/')
     savename = split_file[-1]
@@ -308,12 +305,5 @@ if __name__ == '__main__':
     data = []
     for inFile in inFiles:
         print(inFile)
-        current = measurement(inFile, float(size))
-        if CLEANED == True:       
-            current.clean()
-        for item in thresholds:
-            current.findThresholdStrain(item)
-        for item in strains:
-            current.findResistanceAtStrain(item)
-        data.append(current)
+        data.append(analyze(inFile, float(size), CLEANED))
     writeToXlsx(filename, data)
\ No newline at end of file
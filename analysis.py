@@ -0,0 +1,18 @@
+# Per-file analysis shared by the GUI script (ParticleECRanalyze.py) and the campaign workers (campaign.py)
+# Kept free of Tkinter so it can run on headless nodes
+
+from measurement import measurement
+
+thresholds = [5, 10, 100] # Resistance thresholds under which to calculate strain
+strains = [0.1, 0.15, 0.2, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6] # Strains at which to find resistance
+
+def analyze(inFile, size, cleaned=False):
+    # Builds a measurement from a .txt/.ecr pair and fills in its statistics
+    current = measurement(inFile, size)
+    if cleaned == True:
+        current.clean()
+    for item in thresholds:
+        current.findThresholdStrain(item)
+    for item in strains:
+        current.findResistanceAtStrain(item)
+    return current
@@ -0,0 +1,430 @@
+# Sharded campaign runner for large sets of .txt/.ecr indent files
+# Splits the campaign into shards that any number of worker processes (on any node sharing the campaign folder) can claim,
+# analyzes each shard with measurement and merges the per-shard results into the Statistics workbook and a summary file
+
+# Campaign folder layout:
+#   campaign.json                  settings shared by all workers (particle size, clean, shard count)
+#   manifest.tsv                   index, .txt path and .ecr path of every input pair
+#   shards/shard_NNNNN.tsv         the manifest lines belonging to one shard
+#   shards/shard_NNNNN.lock        exists while a worker owns the shard, touched after every file as a heartbeat
+#   shards/shard_NNNNN.json        per-shard results, written atomically once the shard is done
+
+# Locks are created with O_CREAT|O_EXCL, so the shared filesystem must honour exclusive creates (local disks, NFSv3+).
+# Each lock holds the 'host:pid' of its owner. A lock whose owner process is gone on the same host is taken over at once;
+# a lock on another host is taken over once it has had no heartbeat for the stale timeout.
+# Lock ages are measured against the mtime of a file the checking worker has just written to the same filesystem,
+# so the node clocks do not need to agree (client attribute caching still adds up to a few seconds of slack).
+
+import sys
+import getopt
+import os
+import os.path
+import errno
+import json
+import time
+import socket
+import math
+import multiprocessing
+from glob import glob
+import numpy as np
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
+from analysis import analyze
+
+SHARD_SIZE = 200 # Number of indent files per shard
+STALE_AFTER = 3600 # Seconds without heartbeat after which a shard lock is considered abandoned
+POLL_INTERVAL = 30 # Seconds between checks while other workers still hold the remaining shards
+
+def shardDir(campaignDir):
+    return os.path.join(campaignDir, 'shards')
+
+def shardPath(campaignDir, shard, ext):
+    return os.path.join(shardDir(campaignDir), 'shard_%05d.%s' % (shard, ext))
+
+def workerId():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def findInputs(inputs):
+    # Accepts .txt files, glob patterns and folders (all .txt files inside); returns sorted list of .txt paths
+    txtFiles = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            txtFiles.update(glob(os.path.join(item, '*.txt')))
+        else:
+            txtFiles.update(f for f in glob(item) if f.endswith('.txt'))
+    return sorted(os.path.abspath(f) for f in txtFiles)
+
+def writeManifest(campaignDir, inputs, size, cleaned=False, shardSize=SHARD_SIZE):
+    # Writes the manifest of .txt/.ecr pairs and splits it into shards. Returns the number of shards.
+    if shardSize < 1:
+        raise ValueError('Shard size must be at least 1')
+    configFile = os.path.join(campaignDir, 'campaign.json')
+    if os.path.exists(configFile):
+        raise IOError('A campaign already exists in ' + campaignDir)
+    txtFiles = findInputs(inputs)
+    if not txtFiles:
+        raise IOError('No .txt files found')
+    if not os.path.isdir(shardDir(campaignDir)):
+        os.makedirs(shardDir(campaignDir))
+
+    lines = []
+    missingECR = 0
+    for idx, txt in enumerate(txtFiles):
+        ecr = txt[:-4]+'.ecr' # Same pairing as measurement.merge
+        if not os.path.isfile(ecr):
+            missingECR += 1
+            ecr = ''
+        lines.append('%d\t%s\t%s\n' % (idx, txt, ecr))
+    if missingECR:
+        print(str(missingECR) + ' .txt files have no .ecr file; only mechanical data will be analyzed for these.')
+
+    with open(os.path.join(campaignDir, 'manifest.tsv'), 'w') as f:
+        f.writelines(lines)
+    shards = int(math.ceil(len(lines)/float(shardSize)))
+    for shard in range(shards):
+        with open(shardPath(campaignDir, shard, 'tsv'), 'w') as f:
+            f.writelines(lines[shard*shardSize:(shard+1)*shardSize])
+
+    # Config is written last: workers only start once the manifest and all shards are in place
+    config = {'size':size, 'cleaned':cleaned, 'shardSize':shardSize, 'shards':shards, 'files':len(lines)}
+    tmp = configFile + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(config, f, indent=1)
+    os.rename(tmp, configFile)
+    return shards
+
+def readConfig(campaignDir):
+    with open(os.path.join(campaignDir, 'campaign.json'), 'r') as f:
+        return json.load(f)
+
+def readShard(campaignDir, shard):
+    entries = []
+    with open(shardPath(campaignDir, shard, 'tsv'), 'r') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 3:
+                continue
+            entries.append((int(parts[0]), parts[1], parts[2]))
+    return entries
+
+def takeLock(lock, worker):
+    # Atomic on the shared filesystem: only one process can create the lock file
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, (worker + '\n').encode('utf-8'))
+    os.close(fd)
+    return True
+
+def readLock(lock):
+    # Returns the worker id written into the lock, or None if there is no lock
+    try:
+        with open(lock, 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def releaseLock(lock, worker):
+    # Removes the lock only while it still belongs to worker, so a lock that was taken over is left to its new owner
+    if readLock(lock) != worker:
+        return False
+    try:
+        os.remove(lock)
+    except OSError:
+        return False
+    return True
+
+def touchLock(lock, worker):
+    # Heartbeat. Returns False once the lock no longer belongs to worker.
+    if readLock(lock) != worker:
+        return False
+    try:
+        os.utime(lock, None)
+    except OSError:
+        return False
+    return True
+
+def fsTime(campaignDir, worker):
+    # Current time according to the shared filesystem, so lock ages do not depend on the node clocks agreeing
+    clock = os.path.join(shardDir(campaignDir), 'clock_' + worker.replace(':', '_') + '.tmp')
+    with open(clock, 'w'):
+        pass
+    now = os.path.getmtime(clock)
+    os.remove(clock)
+    return now
+
+def ownerDead(owner):
+    # True if the owner ran on this host and its process no longer exists
+    try:
+        (host, pid) = owner.rsplit(':', 1)
+        pid = int(pid)
+    except (AttributeError, ValueError): # No lock or lock content not written yet
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+def lockAge(lock, now):
+    try:
+        return now - os.path.getmtime(lock)
+    except OSError: # Lock was released in the meantime
+        return None
+
+def isAbandoned(lock, staleAfter, now):
+    # A lock is abandoned if its owner died on this host or it has had no heartbeat for staleAfter seconds
+    owner = readLock(lock)
+    if owner is None:
+        return False
+    if ownerDead(owner):
+        return True
+    age = lockAge(lock, now)
+    return age is not None and age > staleAfter
+
+def breakLock(lock, worker, staleAfter, now):
+    # Takes over the lock of a crashed worker. A second exclusive lock makes sure only one worker
+    # re-checks and replaces the abandoned lock, so a freshly taken lock is never removed.
+    breaker = lock + '.break'
+    if not takeLock(breaker, worker):
+        owner = readLock(breaker)
+        if isAbandoned(breaker, staleAfter, now): # Worker crashed while breaking the lock
+            releaseLock(breaker, owner)
+        return False
+    try:
+        owner = readLock(lock)
+        if not isAbandoned(lock, staleAfter, now):
+            return False
+        releaseLock(lock, owner)
+        print('Taking over abandoned lock ' + lock + ' from ' + str(owner))
+        return takeLock(lock, worker)
+    finally:
+        releaseLock(breaker, worker)
+
+def claimShard(campaignDir, worker, staleAfter=STALE_AFTER):
+    # Returns the index of an unfinished shard now owned by this worker, or None when there is nothing left to claim
+    config = readConfig(campaignDir)
+    now = fsTime(campaignDir, worker)
+    for shard in range(config['shards']):
+        if os.path.exists(shardPath(campaignDir, shard, 'json')):
+            continue
+        lock = shardPath(campaignDir, shard, 'lock')
+        if not takeLock(lock, worker):
+            if not (isAbandoned(lock, staleAfter, now) and breakLock(lock, worker, staleAfter, now)):
+                continue
+        if os.path.exists(shardPath(campaignDir, shard, 'json')): # Finished between the check and taking the lock
+            releaseLock(lock, worker)
+            continue
+        return shard
+    return None
+
+def processShard(campaignDir, shard, worker, config):
+    # Returns False if the lock was taken over before the shard was finished
+    lock = shardPath(campaignDir, shard, 'lock')
+    try:
+        results = []
+        for (idx, txt, ecr) in readShard(campaignDir, shard):
+            print(txt)
+            result = {'index':idx, 'file':txt, 'fileName':os.path.basename(txt), 'statistics':[], 'error':None}
+            try:
+                current = analyze(txt, float(config['size']), config['cleaned'])
+                # Stored as a list of pairs so the column order of measurement.statistics survives the merge
+                result['statistics'] = [[key, value] for key, value in current.statistics.items()]
+            except Exception as e:
+                print('Analysis of ' + txt + ' failed: ' + str(e))
+                result['error'] = '%s: %s' % (type(e).__name__, e)
+            results.append(result)
+            if not touchLock(lock, worker):
+                print(worker + ' lost the lock on shard ' + str(shard) + ', leaving it to ' + str(readLock(lock)))
+                return False
+
+        # Write to a worker-specific temporary file and rename, so a result file is never seen half-written
+        tmp = shardPath(campaignDir, shard, 'json') + '.' + worker.replace(':', '_') + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'shard':shard, 'worker':worker, 'results':results}, f)
+        os.rename(tmp, shardPath(campaignDir, shard, 'json'))
+        return True
+    finally:
+        # Also on unexpected errors, so the shard does not stay blocked until the lock goes stale
+        releaseLock(lock, worker)
+
+def reportLocked(campaignDir, worker, missing, staleAfter):
+    now = fsTime(campaignDir, worker)
+    for shard in missing:
+        lock = shardPath(campaignDir, shard, 'lock')
+        owner = readLock(lock)
+        age = lockAge(lock, now)
+        if owner is None or age is None:
+            continue
+        print('Shard %d is locked by %s, taken over in %d s unless it finishes' % (shard, owner, max(0, staleAfter-age)))
+    return
+
+def runWorker(campaignDir, staleAfter=STALE_AFTER):
+    # Claims and processes shards until every shard has results, waiting for shards locked by other workers
+    # to finish or become abandoned. Returns the number of shards processed by this worker.
+    worker = workerId()
+    config = readConfig(campaignDir)
+    done = 0
+    while True:
+        shard = claimShard(campaignDir, worker, staleAfter)
+        if shard is None:
+            missing = missingShards(campaignDir)
+            if not missing:
+                break
+            reportLocked(campaignDir, worker, missing, staleAfter)
+            time.sleep(min(POLL_INTERVAL, staleAfter))
+            continue
+        print(worker + ' processing shard ' + str(shard))
+        if processShard(campaignDir, shard, worker, config):
+            done += 1
+    print(worker + ' finished, ' + str(done) + ' shards processed')
+    return done
+
+def runLocalWorkers(campaignDir, processes, staleAfter=STALE_AFTER):
+    # Starts several workers on this machine and waits for them to finish
+    workers = [multiprocessing.Process(target=runWorker, args=(campaignDir, staleAfter)) for i in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    return
+
+def missingShards(campaignDir):
+    config = readConfig(campaignDir)
+    return [shard for shard in range(config['shards']) if not os.path.exists(shardPath(campaignDir, shard, 'json'))]
+
+def collectResults(campaignDir):
+    # Returns all per-file results in manifest order; raises IOError if shards are still unfinished
+    missing = missingShards(campaignDir)
+    if missing:
+        raise IOError(str(len(missing)) + ' shards have no results yet: ' + ', '.join(str(s) for s in missing) + '. Run (more) workers to finish them.')
+    results = []
+    for shard in range(readConfig(campaignDir)['shards']):
+        with open(shardPath(campaignDir, shard, 'json'), 'r') as f:
+            results.extend(json.load(f)['results'])
+    results.sort(key=lambda r: r['index'])
+    return results
+
+def writeStatistics(filename, results):
+    # Same layout as the Statistics sheet of ParticleECRanalyze.writeToXlsx. Returns the column headers in sheet order.
+    workbook = xlsxwriter.Workbook(filename+'.xlsx')
+    statSheet = workbook.add_worksheet('Statistics')
+    statSheet.write(0,0, 'Data series')
+    statHeaders = []
+    for idx, result in enumerate(results):
+        statSheet.write(idx+1,0,result['fileName'])
+        for key, value in result['statistics']:
+            if key not in statHeaders: # Then we need to create a new column to fill out
+                statHeaders.append(key)
+                statSheet.write(0,len(statHeaders),key)
+            statSheet.write(idx+1,statHeaders.index(key)+1,value)
+
+    last = len(results)+1 # Last data row in Excel numbering
+    statSheet.write(last,0,'Average')
+    statSheet.write(last+1,0,'Stdev')
+    statSheet.write(last+2,0,'\% Particles no data')
+    for r, header in enumerate(statHeaders):
+        cells = xl_col_to_name(r+1)+'2:'+xl_col_to_name(r+1)+str(last)
+        statSheet.write_formula(last,r+1,'=AVERAGE('+cells+')')
+        statSheet.write_formula(last+1,r+1,'=STDEV('+cells+')')
+        statSheet.write_formula(last+2,r+1,'=COUNTBLANK('+cells+')*100/'+str(len(results)))
+    workbook.close()
+    return statHeaders
+
+def writeSummary(filename, results, failed, statHeaders):
+    # Tab separated summary of every statistic, plus the files that could not be analyzed
+    with open(filename+'_summary.txt', 'w') as f:
+        f.write('Files analyzed\t%d\n' % len(results))
+        f.write('Files failed\t%d\n\n' % len(failed))
+        f.write('Statistic\tN\tAverage\tStdev\t% Particles no data\n')
+        for header in statHeaders:
+            values = []
+            for result in results:
+                value = dict((k, v) for k, v in result['statistics']).get(header)
+                if isinstance(value, (int, float)):
+                    values.append(value)
+            average = np.mean(values) if values else ''
+            stdev = np.std(values, ddof=1) if len(values) > 1 else ''
+            noData = 100.0*(len(results)-len(values))/len(results) if results else ''
+            f.write('%s\t%d\t%s\t%s\t%s\n' % (header, len(values), average, stdev, noData))
+        if failed:
+            f.write('\nFailed files\n')
+            for result in failed:
+                f.write('%s\t%s\n' % (result['file'], result['error']))
+    return
+
+def reduceCampaign(campaignDir, filename):
+    # Merges all shard results into filename.xlsx (Statistics sheet) and filename_summary.txt
+    allResults = collectResults(campaignDir)
+    results = [r for r in allResults if r['error'] is None]
+    failed = [r for r in allResults if r['error'] is not None]
+    statHeaders = writeStatistics(filename, results)
+    writeSummary(filename, results, failed, statHeaders)
+    print('Merged ' + str(len(results)) + ' files, ' + str(len(failed)) + ' failed.')
+    return
+
+def usage():
+    print('Sharded campaign runner for large sets of indent files.\n Usage:\n python campaign.py prepare -d diameter [-s shardsize] [-c] campaigndir inputs... \n python campaign.py work [-j processes] [-t staleseconds] campaigndir \n python campaign.py reduce campaigndir outputname \n prepare: writes the manifest of .txt/.ecr pairs (inputs are .txt files, glob patterns or folders) and splits it into shards. -d, --diameter: particle diameter in um. -s, --shardsize: files per shard. -c, --clean: removes mechanical data points without electrical data. \n work: claims and analyzes shards until none are left; start as many as you like on any node sharing campaigndir. Waits for shards locked by other workers and takes over the shards of crashed workers. -j, --processes: number of local worker processes. -t, --stale: seconds after which the lock of a silent worker is taken over. \n reduce: merges the shard results into outputname.xlsx and outputname_summary.txt.')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('prepare', 'work', 'reduce'):
+        usage()
+        sys.exit(2)
+    command = sys.argv[1]
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "hd:s:cj:t:", ["help", "diameter=", "shardsize=", "clean", "processes=", "stale="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    size = None
+    shardSize = SHARD_SIZE
+    cleaned = False
+    processes = 1
+    staleAfter = STALE_AFTER
+    try:
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                usage()
+                sys.exit()
+            elif opt in ("-d", "--diameter"):
+                size = float(arg)
+            elif opt in ("-s", "--shardsize"):
+                shardSize = int(arg)
+            elif opt in ("-c", "--clean"):
+                cleaned = True
+            elif opt in ("-j", "--processes"):
+                processes = int(arg)
+            elif opt in ("-t", "--stale"):
+                staleAfter = float(arg)
+    except ValueError: # Non-numeric option value
+        usage()
+        sys.exit(2)
+    if shardSize < 1 or processes < 1 or staleAfter <= 0:
+        usage()
+        sys.exit(2)
+
+    if command == 'prepare':
+        if size is None or len(args) < 2:
+            usage()
+            sys.exit(2)
+        shards = writeManifest(args[0], args[1:], size, cleaned, shardSize)
+        print('Campaign written to ' + args[0] + ' with ' + str(shards) + ' shards.')
+    elif command == 'work':
+        if len(args) != 1:
+            usage()
+            sys.exit(2)
+        if processes > 1:
+            runLocalWorkers(args[0], processes, staleAfter)
+        else:
+            runWorker(args[0], staleAfter)
+    elif command == 'reduce':
+        if len(args) != 2:
+            usage()
+            sys.exit(2)
+        try:
+            reduceCampaign(args[0], args[1])
+        except IOError as e:
+            sys.exit(str(e))
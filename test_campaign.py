@@ -0,0 +1,121 @@
+# Tests for the sharded campaign runner; run with: python -m pytest test_campaign.py
+
+import os
+import subprocess
+import sys
+import multiprocessing
+from collections import OrderedDict
+import pytest
+import campaign
+
+# The stubbed analyze only reaches the worker processes if they are forked
+needsFork = pytest.mark.skipif(sys.platform == 'win32' or multiprocessing.get_start_method() != 'fork',
+                               reason='worker processes must be forked to inherit the stubbed analyze')
+
+class FakeMeasurement:
+    def __init__(self, statistics):
+        self.statistics = statistics
+
+def fakeAnalyze(inFile, size, cleaned=False):
+    if 'bad' in os.path.basename(inFile):
+        raise ValueError('broken indent file')
+    number = int(os.path.basename(inFile)[1:4])
+    return FakeMeasurement(OrderedDict([('Min R', float(number)), ('Recovery ratio', size)]))
+
+@pytest.fixture
+def campaignDir(tmp_path, monkeypatch):
+    monkeypatch.setattr(campaign, 'analyze', fakeAnalyze)
+    monkeypatch.setattr(campaign, 'POLL_INTERVAL', 0.1) # Idle workers wait for the others to finish
+    inDir = tmp_path / 'in'
+    inDir.mkdir()
+    for i in range(20):
+        (inDir / ('p%03d.txt' % i)).write_text(u'')
+        if i % 2:
+            (inDir / ('p%03d.ecr' % i)).write_text(u'')
+    (inDir / 'bad.txt').write_text(u'')
+    d = str(tmp_path / 'campaign')
+    assert campaign.writeManifest(d, [str(inDir)], 5.0, shardSize=3) == 7
+    return d
+
+def shardFiles(d, ext):
+    return sorted(f for f in os.listdir(campaign.shardDir(d)) if f.endswith('.' + ext))
+
+def plantLock(d, shard, owner, age=0):
+    lock = campaign.shardPath(d, shard, 'lock')
+    with open(lock, 'w') as f:
+        f.write(owner + '\n')
+    if age:
+        old = os.path.getmtime(lock) - age
+        os.utime(lock, (old, old))
+    return lock
+
+def deadPid():
+    p = subprocess.Popen([sys.executable, '-c', 'pass'])
+    p.wait()
+    return p.pid
+
+@needsFork
+def test_local_workers_merge_in_manifest_order(campaignDir, tmp_path):
+    campaign.runLocalWorkers(campaignDir, 3)
+    assert len(shardFiles(campaignDir, 'json')) == 7
+    assert shardFiles(campaignDir, 'lock') == []
+    assert campaign.missingShards(campaignDir) == []
+
+    out = str(tmp_path / 'out')
+    campaign.reduceCampaign(campaignDir, out)
+    assert os.path.isfile(out + '.xlsx')
+    results = campaign.collectResults(campaignDir)
+    assert [r['index'] for r in results] == list(range(21))
+    assert [r['fileName'] for r in results] == ['bad.txt'] + ['p%03d.txt' % i for i in range(20)]
+    assert results[5]['statistics'] == [['Min R', 4.0], ['Recovery ratio', 5.0]]
+
+@needsFork
+def test_failed_file_in_summary(campaignDir, tmp_path):
+    campaign.runLocalWorkers(campaignDir, 3)
+    out = str(tmp_path / 'out')
+    campaign.reduceCampaign(campaignDir, out)
+    with open(out + '_summary.txt') as f:
+        summary = f.read()
+    assert 'Files analyzed\t20\n' in summary
+    assert 'Files failed\t1\n' in summary
+    failed = summary.split('Failed files\n')[1]
+    assert 'bad.txt\tValueError: broken indent file' in failed
+
+def test_stale_lock_taken_over(campaignDir):
+    plantLock(campaignDir, 2, 'othernode:12345', age=1000)
+    assert campaign.runWorker(campaignDir, staleAfter=5) == 7
+    assert campaign.missingShards(campaignDir) == []
+    assert shardFiles(campaignDir, 'lock') == []
+
+def test_dead_owner_lock_taken_over_at_once(campaignDir):
+    plantLock(campaignDir, 0, '%s:%d' % (campaign.socket.gethostname(), deadPid()))
+    assert campaign.runWorker(campaignDir) == 7
+    assert campaign.missingShards(campaignDir) == []
+
+def test_live_lock_is_not_broken(campaignDir):
+    lock = plantLock(campaignDir, 1, 'othernode:12345')
+    worker = campaign.workerId()
+    assert campaign.claimShard(campaignDir, worker, staleAfter=600) == 0
+    assert campaign.claimShard(campaignDir, worker, staleAfter=600) == 2
+    assert campaign.readLock(lock) == 'othernode:12345'
+
+def test_release_and_heartbeat_leave_other_owner_alone(campaignDir):
+    lock = plantLock(campaignDir, 0, 'othernode:12345', age=1000)
+    mtime = os.path.getmtime(lock)
+    assert not campaign.touchLock(lock, campaign.workerId())
+    assert not campaign.releaseLock(lock, campaign.workerId())
+    assert os.path.getmtime(lock) == mtime
+    assert campaign.releaseLock(lock, 'othernode:12345')
+    assert not os.path.exists(lock)
+
+def test_reduce_raises_while_shards_missing(campaignDir, tmp_path):
+    worker = campaign.workerId()
+    shard = campaign.claimShard(campaignDir, worker)
+    campaign.processShard(campaignDir, shard, worker, campaign.readConfig(campaignDir))
+    assert campaign.missingShards(campaignDir) == [1, 2, 3, 4, 5, 6]
+    with pytest.raises(IOError):
+        campaign.reduceCampaign(campaignDir, str(tmp_path / 'out'))
+
+def test_shard_size_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        campaign.writeManifest(str(tmp_path / 'campaign'), [str(tmp_path)], 5.0, shardSize=0)